@@ -1,9 +1,19 @@
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-from typing import Dict, Any, Optional
-from pydantic import BaseModel
-import json
-from openai import OpenAI
-import fitz  # PyMuPDF
+from typing import AsyncIterator, BinaryIO, Dict, Any, Iterator, Optional
+import asyncio
+import functools
+import hashlib
+import orjson
+import math
+import os
+import pickle
+import re
+import time
+import numpy as np
+import tiktoken
+from openai import AsyncOpenAI
+import pypdfium2 as pdfium
 from termcolor import colored
 from datetime import datetime
 import shutil
@@ -17,131 +27,597 @@ PDF_DIR = BASE_DIR / "pdfs"
 KNOWLEDGE_DIR = BASE_DIR / "knowledge_bases"
 SUMMARIES_DIR = BASE_DIR / "summaries"
 PDF_PATH = PDF_DIR / PDF_NAME
-OUTPUT_PATH = KNOWLEDGE_DIR / f"{PDF_NAME.replace('.pdf', '_knowledge.json')}"
+PDF_STEM = PDF_NAME.removesuffix('.pdf')
+OUTPUT_PATH = KNOWLEDGE_DIR / f"{PDF_STEM}_knowledge.json"
+KNOWLEDGE_LOG_PATH = KNOWLEDGE_DIR / f"{PDF_STEM}_knowledge.jsonl"
+BATCH_REQUESTS_PATH = KNOWLEDGE_DIR / f"{PDF_STEM}_batch_requests.jsonl"
+SEMANTIC_CACHE_PATH = BASE_DIR / "cache" / "semantic_cache.pkl"  # Outside the per-run directories so it survives between runs
 ANALYSIS_INTERVAL = 20  # Set to None to skip interval analyses, or a number (e.g., 10) to generate analysis every N pages
 MODEL = "gpt-4o-mini"
+EMBEDDING_MODEL = "text-embedding-3-small"
 ANALYSIS_MODEL = "o1-mini"
 TEST_PAGES = 60  # Set to None to process entire book
+MAX_CONCURRENT_REQUESTS = 20  # Upper bound on in-flight page requests, keep under your OpenAI tier's RPM
+REQUESTS_PER_MINUTE = 500  # Your OpenAI tier's request limit for MODEL; page requests are throttled to stay under it
+TOKENS_PER_MINUTE = 200_000  # Your OpenAI tier's token limit for MODEL; page requests are throttled to stay under it
+MAX_PAGE_TOKENS = 4000  # Longer pages (OCR noise, reference dumps) are cut to this many tokens before any API call
+COMPLETION_TOKENS_PER_PAGE = 300  # Expected output tokens per page, counted against TOKENS_PER_MINUTE before a request
+PAGES_PER_REQUEST = 5  # Pages sent together in one request; keep the combined text well inside the context window
+USE_BATCH_API = False  # Set to True to submit every page through OpenAI's Batch API: half the cost, but results can take up to 24h
+BATCH_POLL_SECONDS = 30  # How often to check on a submitted batch
+SEMANTIC_CACHE_THRESHOLD = 0.92  # Cosine similarity at which a page reuses a cached result; set to None to disable the cache
+EMBEDDING_BATCH_TOKENS = 250_000  # Token budget per embeddings request; OpenAI rejects requests over 300k tokens in total
+EMBEDDING_BATCH_SIZE = 2048  # OpenAI's limit on inputs per embeddings request
+EXTRACTION_PAGES_PER_WORKER = 500  # Pages per text-extraction process; shorter books are extracted in-process
+MIN_PAGE_CHARACTERS = 200  # Pages with less text than this are skipped without calling the model
+MAX_DIGIT_RATIO = 0.3  # Pages with more digits per letter than this (contents, index) are skipped without calling the model
+SKIP_PAGE_PATTERN = re.compile(r"Copyright\s*(?:©|\(c\))|\bISBN\b|^\s*Bibliography\b", re.IGNORECASE | re.MULTILINE)
 
+# Summaries written so far per kind, reset in setup_directories and advanced by save_summary
+summary_counts = {"interval": 0, "final": 0}
 
-class PageContent(BaseModel):
-    has_content: bool
-    knowledge: list[str]
+
+# System prompts are module constants so every request starts with a byte-identical prefix, which
+# OpenAI's automatic prompt cache needs. PAGE_SYSTEM_PROMPT is kept above 1024 tokens so it qualifies
+# for caching; never interpolate anything page-specific into either prompt.
+PAGE_SYSTEM_PROMPT = """Analyze each page as if you're studying from a book.
+
+You will be given the raw text of one or more pages extracted from a PDF. Each page is wrapped
+in <PAGE n> and </PAGE n> tags, where n is its page number. Analyze every page on its own and
+return exactly one entry per page in the pages list, in the same order, with page_number set
+to the n from its tag. Never merge pages or move knowledge from one page to another.
+
+The text may contain running headers, footers, page numbers, hyphenated line breaks and other
+extraction noise. Ignore that noise and judge the page by what a careful reader would actually
+learn from it.
+
+SKIP content if the page contains:
+- Table of contents
+- Chapter listings
+- Index pages
+- Blank pages
+- Copyright information
+- Publishing details
+- References or bibliography
+- Acknowledgments
+
+How to recognize pages to skip:
+- Table of contents and chapter listings are mostly short titles followed by page numbers,
+  often with dotted leaders ("Chapter 3 . . . . . 47") and little or no running prose
+- Index pages are alphabetical lists of terms followed by comma-separated page numbers
+- Blank pages contain nothing, or only a page number, a running header or a chapter title
+- Copyright and publishing pages mention rights reserved, ISBN numbers, printing history,
+  publisher addresses, Library of Congress data, editions or cover designers
+- Reference and bibliography pages list authors, titles, journals, years and page ranges
+- Acknowledgments thank people, institutions, editors, reviewers or funding bodies
+- Dedications, epigraphs without commentary, series listings, "also by this author" pages
+  and advertisements for other books should be skipped as well
+
+DO extract knowledge if the page contains:
+- Preface content that explains important concepts
+- Actual educational content
+- Key definitions and concepts
+- Important arguments or theories
+- Examples and case studies
+- Significant findings or conclusions
+- Methodologies or frameworks
+- Critical analyses or interpretations
+
+How to recognize pages worth extracting:
+- The page has running prose that explains, argues, defines, narrates or demonstrates something
+- An introduction or preface counts when it explains ideas, not when it only thanks people
+- A page that mixes a chapter heading with the first paragraphs of the chapter has content
+- A page that is mostly a worked example, a proof, a dialogue or a case study has content
+- Exercises and problem sets have content when they state facts, rules or results worth
+  remembering; skip them when they only ask questions without teaching anything
+
+For valid content:
+- Set has_content to true
+- Extract detailed, learnable knowledge points
+- Include important quotes or key statements
+- Capture examples with their context
+- Preserve technical terms and definitions
+
+How to write knowledge points:
+- Each knowledge point is one self-contained statement that makes sense without the page
+- Prefer complete sentences over fragments or keywords
+- Name the concept, person or idea explicitly instead of writing "it", "this" or "the author"
+  when the referent would be unclear out of context
+- Keep definitions precise and keep the book's own technical vocabulary
+- When quoting, reproduce the quote exactly and say who said it or where it appears
+- When capturing an example, state what the example illustrates, not only the example itself
+- Do not add knowledge that is not supported by the page, and do not speculate
+- Do not repeat the same point twice in different words
+- Do not describe the page itself ("this page discusses...") - state the knowledge directly
+- Aim for as many points as the page genuinely supports: a dense page may yield ten or more,
+  a light page may yield one or two
+
+Example of a page to skip:
+"CONTENTS / Introduction . . . 1 / Book One . . . 9 / Book Two . . . 17 / Book Three . . . 25"
+Result: has_content is false and knowledge is an empty list.
+
+Another example of a page to skip:
+"Copyright 2006 by the translator. All rights reserved. ISBN 0-000-00000-0. Printed in the
+United States of America. Cover design by the publisher's art department."
+Result: has_content is false and knowledge is an empty list.
+
+Example of a page to extract:
+"Begin the morning by saying to thyself, I shall meet with the busy-body, the ungrateful,
+arrogant, deceitful, envious, unsocial. All these things happen to them by reason of their
+ignorance of what is good and evil. But I can neither be injured by any of them, nor can I
+be angry with my kinsman, nor hate him; for we are made for co-operation."
+Result: has_content is true and knowledge contains points such as:
+- "Marcus Aurelius advises beginning each morning by expecting to meet difficult people:
+  busy-bodies, the ungrateful, the arrogant, the deceitful, the envious and the unsocial."
+- "He attributes such behaviour to ignorance of what is good and evil, not to malice."
+- "He argues that others' wrongdoing cannot injure him, so he has no reason for anger or hatred."
+- "Humans are made for co-operation, which is why he refuses to hate his kinsman."
+
+Example of a technical page to extract:
+"Definition 1.2. An integer n is even if n = 2k for some integer k, and odd if n = 2k + 1 for
+some integer k. Example: 14 is even because 14 = 2 x 7."
+Result: has_content is true and knowledge contains points such as:
+- "Definition: an integer n is even if n = 2k for some integer k."
+- "Definition: an integer n is odd if n = 2k + 1 for some integer k."
+- "Example: 14 is even because 14 = 2 x 7, with k = 7."
+
+For pages to skip:
+- Set has_content to false
+- Return empty knowledge list"""
+
+ANALYSIS_SYSTEM_PROMPT = """Return a concise technical summary of the provided content. Plain text, no preamble.
+
+Put each section heading on its own line in Title Case, at most six words, ending with a colon. Start definitions with "Definition:".
+
+You may be given a current summary followed by new content to add. In that case, extend the summary
+with the new content: keep everything in it that is still accurate, merge the new points into the
+relevant sections or add new sections, and return the complete updated summary."""
+
+# Markdown formatting applied locally to the plain-text analysis as it is written out
+SECTION_HEADING_PATTERN = re.compile(r"^([A-Z][^.!?:;,\n]*):\s*$")
+MAX_HEADING_WORDS = 6
+HEADING_MINOR_WORDS = {"a", "an", "and", "as", "at", "by", "for", "in", "of", "on", "or", "the", "to", "vs", "with"}
+DEFINITION_PATTERN = re.compile(r"^(\s*(?:[-*•]\s+)?)Definition:")
+
+
+# Structured output schema for a batch of pages: one {page_number, has_content, knowledge} entry per page
+PAGE_BATCH_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "BatchPageContent",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "pages": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "page_number": {"type": "integer"},
+                            "has_content": {"type": "boolean"},
+                            "knowledge": {"type": "array", "items": {"type": "string"}},
+                        },
+                        "required": ["page_number", "has_content", "knowledge"],
+                        "additionalProperties": False,
+                    },
+                },
+            },
+            "required": ["pages"],
+            "additionalProperties": False,
+        },
+    },
+}
+
+
+class RateLimiter:
+    """Token buckets for requests and tokens per minute that refill continuously as time passes."""
+
+    def __init__(self, requests_per_minute: int, tokens_per_minute: int):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.available_requests = float(requests_per_minute)
+        self.available_tokens = float(tokens_per_minute)
+        self.last_update = time.monotonic()
+        # Waiters take capacity one at a time, in the order they arrived
+        self.lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self.last_update
+        self.available_requests = min(self.requests_per_minute, self.available_requests + elapsed * self.requests_per_minute / 60)
+        self.available_tokens = min(self.tokens_per_minute, self.available_tokens + elapsed * self.tokens_per_minute / 60)
+        self.last_update = now
+
+    async def acquire(self, tokens: int):
+        # A request larger than the whole bucket could never be admitted, so cap it at a full bucket
+        tokens = min(tokens, self.tokens_per_minute)
+        async with self.lock:
+            while True:
+                self._refill()
+                if self.available_requests >= 1 and self.available_tokens >= tokens:
+                    self.available_requests -= 1
+                    self.available_tokens -= tokens
+                    return
+                # Sleep until the scarcer bucket has refilled enough
+                await asyncio.sleep(max(
+                    (1 - self.available_requests) * 60 / self.requests_per_minute,
+                    (tokens - self.available_tokens) * 60 / self.tokens_per_minute,
+                ))
+
+
+class SemanticCache:
+    """Page results keyed by the normalized embedding of the page text, pickled between runs."""
+
+    def __init__(self, embeddings: np.ndarray, results: list[Dict[str, Any]]):
+        self.embeddings = embeddings
+        self.results = results
+
+    @staticmethod
+    def version() -> str:
+        # Results are only valid for the models and prompt that produced them
+        fingerprint = "\0".join([MODEL, EMBEDDING_MODEL, PAGE_SYSTEM_PROMPT, orjson.dumps(PAGE_BATCH_RESPONSE_FORMAT).decode()])
+        return hashlib.sha256(fingerprint.encode('utf-8')).hexdigest()
+
+    @classmethod
+    def load(cls) -> "SemanticCache":
+        if SEMANTIC_CACHE_PATH.exists():
+            with open(SEMANTIC_CACHE_PATH, 'rb') as f:
+                data = pickle.load(f)
+            if data.get("version") == cls.version():
+                print(colored(f"🗃️  Loaded semantic cache ({len(data['results'])} pages)", "cyan"))
+                return cls(data["embeddings"], data["results"])
+            print(colored("🗃️  Ignoring semantic cache built with a different model or prompt", "yellow"))
+        return cls(np.empty((0, 0), dtype=np.float32), [])
+
+    def lookup(self, embedding: np.ndarray) -> Optional[Dict[str, Any]]:
+        if not self.results:
+            return None
+        # Embeddings are normalized, so the inner product is the cosine similarity
+        similarities = self.embeddings @ embedding
+        best = int(np.argmax(similarities))
+        return self.results[best] if similarities[best] >= SEMANTIC_CACHE_THRESHOLD else None
+
+    def add(self, embeddings: np.ndarray, results: list[Dict[str, Any]]):
+        if not results:
+            return
+        self.embeddings = np.vstack([self.embeddings, embeddings]) if self.results else embeddings
+        self.results.extend(results)
+
+    def save(self):
+        SEMANTIC_CACHE_PATH.parent.mkdir(parents=True, exist_ok=True)
+        with open(SEMANTIC_CACHE_PATH, 'wb') as f:
+            pickle.dump({"version": self.version(), "embeddings": self.embeddings, "results": self.results}, f)
 
 
 def load_or_create_knowledge_base() -> Dict[str, Any]:
-    if Path(OUTPUT_PATH).exists():
-        with open(OUTPUT_PATH, 'r', encoding='utf-8') as f:
-            return json.load(f)
+    if OUTPUT_PATH.exists():
+        with open(OUTPUT_PATH, 'rb') as f:
+            return orjson.loads(f.read())
     return {}
 
 def save_knowledge_base(knowledge_base: list[str]):
-    output_path = KNOWLEDGE_DIR / f"{PDF_NAME.replace('.pdf', '')}_knowledge.json"
     print(colored(f"💾 Saving knowledge base ({len(knowledge_base)} items)...", "blue"))
-    with open(output_path, 'w', encoding='utf-8') as f:
-        json.dump({"knowledge": knowledge_base}, f, indent=2)
+    with open(OUTPUT_PATH, 'wb') as f:
+        f.write(orjson.dumps({"knowledge": knowledge_base}, option=orjson.OPT_INDENT_2))
+
+def iter_page_texts(pdf_document: pdfium.PdfDocument, start: int, stop: int) -> Iterator[str]:
+    # Walk the pages in order and release each page before loading the next one
+    for page_num in range(start, stop):
+        page = pdf_document[page_num]
+        text_page = page.get_textpage()
+        yield text_page.get_text_range()
+        text_page.close()
+        page.close()
 
-def process_page(client: OpenAI, page_text: str, current_knowledge: list[str], page_num: int) -> list[str]:
-    print(colored(f"\n📖 Processing page {page_num + 1}...", "yellow"))
+def extract_page_range(start: int, stop: int) -> list[str]:
+    # PDFium is not thread-safe, so every worker process opens its own handle on the document
+    with pdfium.PdfDocument(PDF_PATH) as pdf_document:
+        return list(iter_page_texts(pdf_document, start, stop))
+
+def extract_page_texts(page_count: int) -> list[str]:
+    workers = min(os.cpu_count() or 1, math.ceil(page_count / EXTRACTION_PAGES_PER_WORKER))
+    if workers <= 1:
+        return extract_page_range(0, page_count)
     
-    completion = client.beta.chat.completions.parse(
-        model=MODEL,
-        messages=[
-            {"role": "system", "content": """Analyze this page as if you're studying from a book. 
-            
-            SKIP content if the page contains:
-            - Table of contents
-            - Chapter listings
-            - Index pages
-            - Blank pages
-            - Copyright information
-            - Publishing details
-            - References or bibliography
-            - Acknowledgments
-            
-            DO extract knowledge if the page contains:
-            - Preface content that explains important concepts
-            - Actual educational content
-            - Key definitions and concepts
-            - Important arguments or theories
-            - Examples and case studies
-            - Significant findings or conclusions
-            - Methodologies or frameworks
-            - Critical analyses or interpretations
-            
-            For valid content:
-            - Set has_content to true
-            - Extract detailed, learnable knowledge points
-            - Include important quotes or key statements
-            - Capture examples with their context
-            - Preserve technical terms and definitions
-            
-            For pages to skip:
-            - Set has_content to false
-            - Return empty knowledge list"""},
-            {"role": "user", "content": f"Page text: {page_text}"}
-        ],
-        response_format=PageContent
+    # Split the pages into one contiguous range per worker and stitch the results back in order
+    bounds = [page_count * worker // workers for worker in range(workers + 1)]
+    print(colored(f"🧵 Extracting text from {page_count} pages with {workers} processes...", "blue"))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return [text for texts in executor.map(extract_page_range, bounds[:-1], bounds[1:]) for text in texts]
+
+def is_skip_page(page_text: str) -> bool:
+    # Cheap local checks for blank, contents, index, copyright and bibliography pages
+    if len(page_text.strip()) < MIN_PAGE_CHARACTERS:
+        return True
+    digits = sum(char.isdigit() for char in page_text)
+    letters = sum(char.isalpha() for char in page_text)
+    if letters == 0 or digits / letters > MAX_DIGIT_RATIO:
+        return True
+    return SKIP_PAGE_PATTERN.search(page_text) is not None
+
+def append_knowledge_log(knowledge_log: BinaryIO, page_num: int, knowledge: list[str]):
+    # One JSON object per line, so each page costs an append instead of a full rewrite
+    for point in knowledge:
+        knowledge_log.write(orjson.dumps({"page": page_num, "knowledge": point}) + b"\n")
+
+def load_knowledge_log(page_count: int) -> list[list[str]]:
+    # Pages finish out of order, so regroup the log entries by page
+    page_knowledge = [[] for _ in range(page_count)]
+    if KNOWLEDGE_LOG_PATH.exists():
+        with open(KNOWLEDGE_LOG_PATH, 'rb') as f:
+            for line in f:
+                entry = orjson.loads(line)
+                page_knowledge[entry["page"]].append(entry["knowledge"])
+    return page_knowledge
+
+@functools.cache
+def get_encoding() -> tiktoken.Encoding:
+    # Loaded on first use, since tiktoken may need to download the encoding
+    return tiktoken.encoding_for_model(MODEL)
+
+def count_tokens(text: str) -> int:
+    # Book text may legitimately contain special-token strings like <|endoftext|>; count them as plain text
+    return len(get_encoding().encode(text, disallowed_special=()))
+
+@functools.cache
+def page_system_prompt_tokens() -> int:
+    return count_tokens(PAGE_SYSTEM_PROMPT)
+
+def truncate_page_text(page_text: str, page_num: int) -> tuple[str, int]:
+    # Returns the (possibly truncated) text with its token count, so later steps don't re-encode it
+    tokens = get_encoding().encode(page_text, disallowed_special=())
+    if len(tokens) <= MAX_PAGE_TOKENS:
+        return page_text, len(tokens)
+    print(colored(f"✂️  Truncating page {page_num + 1} from {len(tokens)} to {MAX_PAGE_TOKENS} tokens", "yellow"))
+    return get_encoding().decode(tokens[:MAX_PAGE_TOKENS]), MAX_PAGE_TOKENS
+
+def estimate_request_tokens(pages: list[tuple[int, str]], page_tokens: Dict[int, int]) -> int:
+    # The <PAGE n> tags add a handful of tokens per page on top of the page text
+    prompt_tokens = page_system_prompt_tokens() + sum(page_tokens[page_num] + 10 for page_num, _ in pages)
+    return prompt_tokens + len(pages) * COMPLETION_TOKENS_PER_PAGE
+
+def build_page_batch_messages(pages: list[tuple[int, str]]) -> list[dict[str, str]]:
+    return [
+        {"role": "system", "content": PAGE_SYSTEM_PROMPT},
+        {"role": "user", "content": "\n".join(
+            f"<PAGE {page_num + 1}>\n{page_text}\n</PAGE {page_num + 1}>" for page_num, page_text in pages
+        )}
+    ]
+
+async def embed_pages(client: AsyncOpenAI, page_texts: list[str], token_counts: list[int]) -> np.ndarray:
+    # Split requests by total tokens, leaving headroom since the embedding model's tokenizer differs from MODEL's
+    requests, current, current_tokens = [], [], 0
+    for page_text, tokens in zip(page_texts, token_counts):
+        if current and (current_tokens + tokens > EMBEDDING_BATCH_TOKENS or len(current) == EMBEDDING_BATCH_SIZE):
+            requests.append(current)
+            current, current_tokens = [], 0
+        current.append(page_text)
+        current_tokens += tokens
+    if current:
+        requests.append(current)
+    
+    embeddings = []
+    for request_texts in requests:
+        response = await client.embeddings.create(model=EMBEDDING_MODEL, input=request_texts)
+        embeddings.extend(item.embedding for item in response.data)
+    embeddings = np.array(embeddings, dtype=np.float32)
+    return embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+
+async def apply_semantic_cache(client: AsyncOpenAI, semantic_cache: SemanticCache, knowledge_log: BinaryIO, pages: list[tuple[int, str]], page_tokens: Dict[int, int]) -> tuple[list[tuple[int, str]], Dict[int, np.ndarray], Dict[int, int]]:
+    # is_skip_page has already dropped blank and near-empty pages, which the embeddings API would reject
+    if not pages:
+        return pages, {}, {}
+    print(colored(f"🔎 Embedding {len(pages)} pages for the semantic cache...", "blue"))
+    embeddings = await embed_pages(
+        client,
+        [page_text for _, page_text in pages],
+        [page_tokens[page_num] for page_num, _ in pages]
     )
+    page_embeddings = {page_num: embedding for (page_num, _), embedding in zip(pages, embeddings)}
     
-    result = completion.choices[0].message.parsed
-    if result.has_content:
-        print(colored(f"✅ Found {len(result.knowledge)} new knowledge points", "green"))
-    else:
-        print(colored("⏭️  Skipping page (no relevant content)", "yellow"))
+    uncached_pages = []
+    for page_num, page_text in pages:
+        cached = semantic_cache.lookup(page_embeddings[page_num])
+        if cached is None:
+            uncached_pages.append((page_num, page_text))
+        elif cached["has_content"]:
+            print(colored(f"♻️  Page {page_num + 1}: reused {len(cached['knowledge'])} cached knowledge points", "green"))
+            append_knowledge_log(knowledge_log, page_num, cached["knowledge"])
+        else:
+            print(colored(f"♻️  Page {page_num + 1}: cached as no relevant content", "yellow"))
+    print(colored(f"🗃️  Semantic cache: {len(pages) - len(uncached_pages)}/{len(pages)} pages served from cache", "blue"))
     
-    updated_knowledge = current_knowledge + (result.knowledge if result.has_content else [])
+    # Near-duplicates within this book (running headers, formulaic passages) aren't in the cache yet, so
+    # group them here: only the first page of each group is sent, and its result is copied to the rest
+    pages_to_send = []
+    duplicate_pages = {}
+    if uncached_pages:
+        uncached_embeddings = np.array([page_embeddings[page_num] for page_num, _ in uncached_pages])
+        similarities = uncached_embeddings @ uncached_embeddings.T
+        group_leaders = []
+        for index, (page_num, page_text) in enumerate(uncached_pages):
+            leader = next((leader for leader in group_leaders if similarities[index, leader] >= SEMANTIC_CACHE_THRESHOLD), None)
+            if leader is None:
+                group_leaders.append(index)
+                pages_to_send.append((page_num, page_text))
+            else:
+                duplicate_pages[page_num] = uncached_pages[leader][0]
+        if duplicate_pages:
+            print(colored(f"🗃️  {len(duplicate_pages)} pages are near-duplicates of other pages in this run and will reuse their results", "blue"))
+    return pages_to_send, page_embeddings, duplicate_pages
+
+def copy_duplicate_results(knowledge_log: BinaryIO, duplicate_pages: Dict[int, int], page_results: Dict[int, Dict[str, Any]]):
+    for page_num, source_page in duplicate_pages.items():
+        result = page_results.get(source_page)
+        if result is None:
+            print(colored(f"⚠️  Page {page_num + 1}: no result for near-duplicate page {source_page + 1} to reuse", "yellow"))
+        elif result["has_content"]:
+            print(colored(f"♻️  Page {page_num + 1}: reused {len(result['knowledge'])} knowledge points from near-duplicate page {source_page + 1}", "green"))
+            append_knowledge_log(knowledge_log, page_num, result["knowledge"])
+        else:
+            print(colored(f"♻️  Page {page_num + 1}: near-duplicate of page {source_page + 1}, no relevant content", "yellow"))
+
+async def process_page_batch(client: AsyncOpenAI, semaphore: asyncio.Semaphore, rate_limiter: RateLimiter, knowledge_log: BinaryIO, pages: list[tuple[int, str]], page_tokens: Dict[int, int]) -> Dict[int, Dict[str, Any]]:
+    page_range = f"{pages[0][0] + 1}-{pages[-1][0] + 1}"
+    messages = build_page_batch_messages(pages)
+    async with semaphore:
+        # Wait for rate limit capacity up front rather than getting throttled and backing off
+        await rate_limiter.acquire(estimate_request_tokens(pages, page_tokens))
+        print(colored(f"\n📖 Processing pages {page_range}...", "yellow"))
+        completion = await client.chat.completions.create(
+            model=MODEL,
+            messages=messages,
+            response_format=PAGE_BATCH_RESPONSE_FORMAT
+        )
     
-    # Update single knowledge base file
-    save_knowledge_base(updated_knowledge)
+    # Cached prompt tokens show whether the shared system prompt prefix was reused
+    cached_tokens = completion.usage.prompt_tokens_details.cached_tokens if completion.usage.prompt_tokens_details else 0
+    print(colored(f"🗄️  Pages {page_range}: {cached_tokens}/{completion.usage.prompt_tokens} prompt tokens served from cache", "blue"))
     
-    return updated_knowledge
+    message = completion.choices[0].message
+    if message.content is None:
+        # Structured output refusals carry no content; report every page of the request as missing
+        print(colored(f"❌ Pages {page_range}: model refused the request: {message.refusal}", "red"))
+        return log_page_batch_results(knowledge_log, pages, {"pages": []})
+    return log_page_batch_results(knowledge_log, pages, orjson.loads(message.content))
+
+def log_page_batch_results(knowledge_log: BinaryIO, pages: list[tuple[int, str]], results: Dict[str, Any]) -> Dict[int, Dict[str, Any]]:
+    requested_pages = {page_num for page_num, _ in pages}
+    page_results = {}
+    for result in results["pages"]:
+        page_num = result["page_number"] - 1
+        if page_num not in requested_pages:
+            print(colored(f"⚠️  Ignoring result for page {result['page_number']}, which was not in this batch", "yellow"))
+            continue
+        if page_num in page_results:
+            print(colored(f"⚠️  Ignoring repeated result for page {result['page_number']}", "yellow"))
+            continue
+        page_results[page_num] = result
+        if result["has_content"]:
+            print(colored(f"✅ Page {page_num + 1}: found {len(result['knowledge'])} new knowledge points", "green"))
+            append_knowledge_log(knowledge_log, page_num, result["knowledge"])
+        else:
+            print(colored(f"⏭️  Skipping page {page_num + 1} (no relevant content)", "yellow"))
+    for page_num in sorted(requested_pages - page_results.keys()):
+        print(colored(f"⚠️  Page {page_num + 1}: no result returned by the model, its knowledge is missing", "yellow"))
+    return page_results
+
+async def process_with_batch_api(client: AsyncOpenAI, knowledge_log: BinaryIO, batches: list[list[tuple[int, str]]]) -> Dict[int, Dict[str, Any]]:
+    # One Batch API request per page batch, using the same messages as the live flow
+    batches_by_id = {f"pages_{batch[0][0] + 1}-{batch[-1][0] + 1}": batch for batch in batches}
+    with open(BATCH_REQUESTS_PATH, 'wb') as f:
+        for custom_id, batch in batches_by_id.items():
+            f.write(orjson.dumps({
+                "custom_id": custom_id,
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": {
+                    "model": MODEL,
+                    "messages": build_page_batch_messages(batch),
+                    "response_format": PAGE_BATCH_RESPONSE_FORMAT,
+                },
+            }) + b"\n")
+    
+    print(colored(f"📤 Uploading {len(batches_by_id)} requests to the Batch API...", "cyan"))
+    with open(BATCH_REQUESTS_PATH, 'rb') as f:
+        requests_file = await client.files.create(file=f, purpose="batch")
+    batch_job = await client.batches.create(
+        input_file_id=requests_file.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h"
+    )
+    
+    while batch_job.status not in ("completed", "failed", "expired", "cancelled"):
+        counts = batch_job.request_counts
+        progress = f"{counts.completed + counts.failed}/{counts.total}" if counts else "0/?"
+        print(colored(f"⏳ Batch {batch_job.id} is {batch_job.status} ({progress} requests done)...", "yellow"))
+        await asyncio.sleep(BATCH_POLL_SECONDS)
+        batch_job = await client.batches.retrieve(batch_job.id)
+    
+    # Successful requests land in the output file; failed requests, and requests still pending when
+    # a batch expires, land in the error file. Expired batches still return whatever finished in time.
+    if not batch_job.output_file_id and not batch_job.error_file_id:
+        raise RuntimeError(f"Batch {batch_job.id} ended with status '{batch_job.status}' and no output: {batch_job.errors}")
+    if batch_job.status != "completed":
+        print(colored(f"⚠️  Batch {batch_job.id} ended with status '{batch_job.status}', using partial results", "yellow"))
+    
+    entries = []
+    for file_id in (batch_job.output_file_id, batch_job.error_file_id):
+        if file_id:
+            contents = await client.files.content(file_id)
+            entries.extend(orjson.loads(line) for line in contents.text.splitlines() if line.strip())
+    
+    page_results = {}
+    answered_ids = set()
+    for entry in entries:
+        custom_id = entry["custom_id"]
+        response = entry.get("response")
+        if entry.get("error") or not response or response["status_code"] != 200:
+            print(colored(f"❌ Request {custom_id} failed: {entry.get('error') or (response and response['body'])}", "red"))
+            continue
+        answered_ids.add(custom_id)
+        message = response["body"]["choices"][0]["message"]
+        if message.get("content") is None:
+            # Structured output refusals carry no content; report every page of the request as missing
+            print(colored(f"❌ Request {custom_id}: model refused the request: {message.get('refusal')}", "red"))
+            page_results.update(log_page_batch_results(knowledge_log, batches_by_id[custom_id], {"pages": []}))
+            continue
+        page_results.update(log_page_batch_results(knowledge_log, batches_by_id[custom_id], orjson.loads(message["content"])))
+    
+    for custom_id, batch in batches_by_id.items():
+        if custom_id not in answered_ids:
+            page_list = ", ".join(str(page_num + 1) for page_num, _ in batch)
+            print(colored(f"⚠️  Pages {page_list}: no result returned by the Batch API, their knowledge is missing", "yellow"))
+    return page_results
 
 def load_existing_knowledge() -> list[str]:
-    knowledge_file = KNOWLEDGE_DIR / f"{PDF_NAME.replace('.pdf', '')}_knowledge.json"
-    if knowledge_file.exists():
+    if OUTPUT_PATH.exists():
         print(colored("📚 Loading existing knowledge base...", "cyan"))
-        with open(knowledge_file, 'r', encoding='utf-8') as f:
-            data = json.load(f)
+        with open(OUTPUT_PATH, 'rb') as f:
+            data = orjson.loads(f.read())
             print(colored(f"✅ Loaded {len(data['knowledge'])} existing knowledge points", "green"))
             return data['knowledge']
     print(colored("🆕 Starting with fresh knowledge base", "cyan"))
     return []
 
-def analyze_knowledge_base(client: OpenAI, knowledge_base: list[str]) -> str:
-    if not knowledge_base:
-        print(colored("\n⚠️  Skipping analysis: No knowledge points collected", "yellow"))
-        return ""
-        
-    print(colored("\n🤔 Generating final book analysis...", "cyan"))
-    completion = client.chat.completions.create(
+async def analyze_knowledge_base(client: AsyncOpenAI, new_knowledge: list[str], running_summary: str = "", is_final: bool = False) -> AsyncIterator[str]:
+    # Only the knowledge collected since the last analysis is sent, on top of the summary so far
+    if not new_knowledge:
+        if running_summary:
+            print(colored("\n⏭️  No new knowledge points since the last analysis, keeping the current summary", "yellow"))
+            # An unchanged interval summary would only duplicate the previous file; the final one is still written
+            if is_final:
+                yield running_summary
+        else:
+            print(colored("\n⚠️  Skipping analysis: No knowledge points collected", "yellow"))
+        return
+    
+    if running_summary:
+        print(colored(f"\n🤔 Extending book analysis with {len(new_knowledge)} new knowledge points...", "cyan"))
+        content = f"Current summary:\n{running_summary}\n\nNew content to add:\n" + "\n".join(new_knowledge)
+    else:
+        print(colored(f"\n🤔 Generating book analysis from {len(new_knowledge)} knowledge points...", "cyan"))
+        content = "Analyze this content:\n" + "\n".join(new_knowledge)
+    # Stream the summary so it can be written out while the model is still generating
+    stream = await client.chat.completions.create(
         model=MODEL,
         messages=[
-            {"role": "system", "content": """Create a comprehensive summary of the provided content in a concise but detailed way, using markdown format.
-           
-            Use markdown formatting:
-            - ## for main sections
-            - ### for subsections
-            - Bullet points for lists
-            - `code blocks` for any code or formulas
-            - **bold** for emphasis
-            - *italic* for terminology
-            - > blockquotes for important notes
-            
-            Return only the markdown summary, nothing else. Do not say 'here is the summary' or anything like that before or after"""},
-            {"role": "user", "content": f"Analyze this content:\n" + "\n".join(knowledge_base)}
-        ]
+            {"role": "system", "content": ANALYSIS_SYSTEM_PROMPT},
+            {"role": "user", "content": content}
+        ],
+        stream=True
     )
+    async for chunk in stream:
+        if chunk.choices and chunk.choices[0].delta.content:
+            yield chunk.choices[0].delta.content
     
     print(colored("✨ Analysis generated successfully!", "green"))
-    return completion.choices[0].message.content
 
 def setup_directories():
-    # Clear all previously generated files
+    # Clear all previously generated files by dropping the directories wholesale; they are recreated below
     for directory in [KNOWLEDGE_DIR, SUMMARIES_DIR]:
-        if directory.exists():
-            for file in directory.glob("*"):
-                file.unlink()  # Delete all files in these directories
+        shutil.rmtree(directory, ignore_errors=True)
     
     # Create all necessary directories
     for directory in [PDF_DIR, KNOWLEDGE_DIR, SUMMARIES_DIR]:
@@ -156,36 +632,61 @@ def setup_directories():
             print(colored(f"📄 Copied PDF to analysis directory: {PDF_PATH}", "green"))
         else:
             raise FileNotFoundError(f"PDF file {PDF_NAME} not found")
+    
+    # SUMMARIES_DIR was just emptied, so summary numbering starts over
+    summary_counts.update(interval=0, final=0)
 
-def save_summary(summary: str, is_final: bool = False):
-    if not summary:
+def is_section_heading(text: str) -> bool:
+    # Only short Title Case lines count, so sentences that introduce a list or quote stay as text
+    words = text.split()
+    return (
+        len(words) <= MAX_HEADING_WORDS
+        and text != "Definition"
+        and all(not word[0].isalpha() or word[0].isupper() or word in HEADING_MINOR_WORDS for word in words)
+    )
+
+def format_summary_line(line: str) -> str:
+    heading = SECTION_HEADING_PATTERN.match(line)
+    if heading and is_section_heading(heading.group(1)):
+        return f"## {heading.group(1)}"
+    return DEFINITION_PATTERN.sub(r"\1**Definition:**", line)
+
+async def save_summary(summary_chunks: AsyncIterator[str], is_final: bool = False) -> str:
+    # Only create the file once there is something to put in it
+    first_chunk = await anext(summary_chunks, None)
+    if first_chunk is None:
         print(colored("⏭️  Skipping summary save: No content to save", "yellow"))
-        return
+        return ""
         
     # Create markdown file with proper naming
-    if is_final:
-        existing_summaries = list(SUMMARIES_DIR.glob(f"{PDF_NAME.replace('.pdf', '')}_final_*.md"))
-        next_number = len(existing_summaries) + 1
-        summary_path = SUMMARIES_DIR / f"{PDF_NAME.replace('.pdf', '')}_final_{next_number:03d}.md"
-    else:
-        existing_summaries = list(SUMMARIES_DIR.glob(f"{PDF_NAME.replace('.pdf', '')}_interval_*.md"))
-        next_number = len(existing_summaries) + 1
-        summary_path = SUMMARIES_DIR / f"{PDF_NAME.replace('.pdf', '')}_interval_{next_number:03d}.md"
+    kind = "final" if is_final else "interval"
+    summary_counts[kind] += 1
+    summary_path = SUMMARIES_DIR / f"{PDF_STEM}_{kind}_{summary_counts[kind]:03d}.md"
     
-    # Create markdown content with metadata
-    markdown_content = f"""# Book Analysis: {PDF_NAME}
+    # Write the metadata header right away and the summary as it streams in, formatting
+    # each line as markdown once it is complete
+    print(colored(f"\n📝 Writing {kind} analysis to markdown as it is generated...", "cyan"))
+    summary = []
+    pending_line = ""
+    with open(summary_path, 'w', encoding='utf-8') as f:  # Added encoding='utf-8'
+        f.write(f"""# Book Analysis: {PDF_NAME}
 Generated on: {datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
 
-{summary}
+""")
+        chunk = first_chunk
+        while chunk is not None:
+            summary.append(chunk)
+            *lines, pending_line = (pending_line + chunk).split("\n")
+            f.writelines(format_summary_line(line) + "\n" for line in lines)
+            chunk = await anext(summary_chunks, None)
+        f.write(format_summary_line(pending_line))
+        f.write("""
 
 ---
 *Analysis generated using AI Book Analysis Tool*
-"""
-    
-    print(colored(f"\n📝 Saving {'final' if is_final else 'interval'} analysis to markdown...", "cyan"))
-    with open(summary_path, 'w', encoding='utf-8') as f:  # Added encoding='utf-8'
-        f.write(markdown_content)
+""")
     print(colored(f"✅ Analysis saved to: {summary_path}", "green"))
+    return "".join(summary)
 
 def print_instructions():
     print(colored("""
@@ -202,11 +703,12 @@ def print_instructions():
 Configuration options:
 - ANALYSIS_INTERVAL: Set to None to skip interval analyses, or a number for analysis every N pages
 - TEST_PAGES: Set to None to process entire book, or a number for partial processing
+- USE_BATCH_API: Set to True to process pages through OpenAI's Batch API (cheaper, but slower)
 
 Press Enter to continue or Ctrl+C to exit...
 """, "cyan"))
 
-def main():
+async def main():
     try:
         print_instructions()
         input()
@@ -215,38 +717,85 @@ def main():
         return
 
     setup_directories()
-    client = OpenAI()
+    client = AsyncOpenAI()
     
     # Load or initialize knowledge base
-    knowledge_base = load_existing_knowledge()
+    existing_knowledge = load_existing_knowledge()
     
-    pdf_document = fitz.open(PDF_PATH)
-    pages_to_process = TEST_PAGES if TEST_PAGES is not None else pdf_document.page_count
+    # Extract every page up front and close the document before the long network-bound phase
+    with pdfium.PdfDocument(PDF_PATH) as pdf_document:
+        page_count = len(pdf_document)
+    pages_to_process = min(TEST_PAGES, page_count) if TEST_PAGES is not None else page_count
+    page_texts = extract_page_texts(pages_to_process)
     
-    print(colored(f"\n📚 Processing {pages_to_process} pages...", "cyan"))
-    for page_num in range(min(pages_to_process, pdf_document.page_count)):
-        page = pdf_document[page_num]
-        page_text = page.get_text()
+    pages = []
+    page_tokens = {}
+    for page_num, page_text in enumerate(page_texts):
+        if is_skip_page(page_text):
+            print(colored(f"⏭️  Skipping page {page_num + 1} (detected as non-content page)", "yellow"))
+        else:
+            page_text, page_tokens[page_num] = truncate_page_text(page_text, page_num)
+            pages.append((page_num, page_text))
+    
+    with open(KNOWLEDGE_LOG_PATH, 'ab') as knowledge_log:
+        # Near-duplicates of previously analyzed pages reuse the cached result instead of calling the model
+        if SEMANTIC_CACHE_THRESHOLD is not None:
+            semantic_cache = SemanticCache.load()
+            pages, page_embeddings, duplicate_pages = await apply_semantic_cache(client, semantic_cache, knowledge_log, pages, page_tokens)
         
-        knowledge_base = process_page(client, page_text, knowledge_base, page_num)
+        # Group the remaining pages so each request carries several of them
+        batches = [pages[start:start + PAGES_PER_REQUEST] for start in range(0, len(pages), PAGES_PER_REQUEST)]
+        page_results = {}
+        if batches and USE_BATCH_API:
+            print(colored(f"\n📚 Processing {len(pages)} pages in {len(batches)} Batch API requests...", "cyan"))
+            page_results = await process_with_batch_api(client, knowledge_log, batches)
+        elif batches:
+            # Send the requests concurrently; the semaphore caps in-flight requests and the
+            # rate limiter keeps them under the account's per-minute limits
+            print(colored(f"\n📚 Processing {len(pages)} pages in {len(batches)} requests (up to {MAX_CONCURRENT_REQUESTS} at a time)...", "cyan"))
+            semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+            rate_limiter = RateLimiter(REQUESTS_PER_MINUTE, TOKENS_PER_MINUTE)
+            for batch_results in await asyncio.gather(*[
+                process_page_batch(client, semaphore, rate_limiter, knowledge_log, batch, page_tokens)
+                for batch in batches
+            ]):
+                page_results.update(batch_results)
         
-        # Generate interval analysis if ANALYSIS_INTERVAL is set
-        if ANALYSIS_INTERVAL:
-            is_interval = (page_num + 1) % ANALYSIS_INTERVAL == 0
-            is_final_page = page_num + 1 == pages_to_process
-            
-            if is_interval and not is_final_page:
+        if SEMANTIC_CACHE_THRESHOLD is not None:
+            copy_duplicate_results(knowledge_log, duplicate_pages, page_results)
+    
+    if SEMANTIC_CACHE_THRESHOLD is not None:
+        semantic_cache.add(
+            np.array([page_embeddings[page_num] for page_num in page_results]),
+            [{"has_content": result["has_content"], "knowledge": result["knowledge"]} for result in page_results.values()]
+        )
+        semantic_cache.save()
+    
+    # Materialize the consolidated knowledge base once, in page order so it reads like the book
+    page_knowledge = load_knowledge_log(pages_to_process)
+    knowledge_base = existing_knowledge + [point for knowledge in page_knowledge for point in knowledge]
+    save_knowledge_base(knowledge_base)
+    
+    # Grow one running summary, feeding it only the knowledge gathered since the previous analysis
+    running_summary = ""
+    summarized_points = 0
+    if ANALYSIS_INTERVAL:
+        collected_points = len(existing_knowledge)
+        for page_num, knowledge in enumerate(page_knowledge[:-1]):
+            collected_points += len(knowledge)
+            if (page_num + 1) % ANALYSIS_INTERVAL == 0:
                 print(colored(f"\n📊 Progress: {page_num + 1}/{pages_to_process} pages processed", "cyan"))
-                interval_summary = analyze_knowledge_base(client, knowledge_base)
-                save_summary(interval_summary, is_final=False)
-        
-        # Always generate final analysis on last page
-        if page_num + 1 == pages_to_process:
-            print(colored(f"\n📊 Final page ({page_num + 1}/{pages_to_process}) processed", "cyan"))
-            final_summary = analyze_knowledge_base(client, knowledge_base)
-            save_summary(final_summary, is_final=True)
+                running_summary = await save_summary(
+                    analyze_knowledge_base(client, knowledge_base[summarized_points:collected_points], running_summary),
+                    is_final=False
+                ) or running_summary
+                summarized_points = collected_points
+    
+    # Always generate final analysis once every page is processed
+    print(colored(f"\n📊 Final page ({pages_to_process}/{pages_to_process}) processed", "cyan"))
+    await save_summary(analyze_knowledge_base(client, knowledge_base[summarized_points:], running_summary, is_final=True), is_final=True)
     
     print(colored("\n✨ Processing complete! ✨", "green", attrs=['bold']))
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    asyncio.run(main())
\ No newline at end of file